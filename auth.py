@@ -0,0 +1,213 @@
+import ssl
+import json
+import time
+import base64
+import hashlib
+import logging
+import secrets
+from datetime import datetime, timedelta, timezone
+
+import streamlit as st
+from cryptography.fernet import Fernet, InvalidToken
+
+logger = logging.getLogger(__name__)
+
+
+# OAuth setup
+AUTHORIZE_URL = 'https://app.meldrx.com/connect/authorize'
+TOKEN_URL = 'https://app.meldrx.com/connect/token'
+REFRESH_TOKEN_URL = 'https://app.meldrx.com/connect/token'
+REVOKE_TOKEN_URL = 'https://app.meldrx.com/connect/revocation'
+REDIRECT_URI = 'https://sagescript-ai.streamlit.app/component/streamlit_oauth.authorize_button'
+# offline_access asks the provider for a refresh token, without it the login ends when the access token expires
+SCOPE = 'openid profile offline_access patient/*.read'
+# Refresh the access token when it expires within this many seconds
+TOKEN_REFRESH_MARGIN = 60
+
+# Session cookie
+TOKEN_COOKIE = 'sagescript_token'
+# Only the fields needed to call and refresh the API, to stay under the 4 KB cookie limit
+COOKIE_TOKEN_FIELDS = ('access_token', 'refresh_token', 'token_type', 'expires_at')
+# How long a cookie with a refresh token is kept, so a returning user is signed back
+# in by refreshing; once the refresh token itself is rejected they have to sign in again
+REFRESH_COOKIE_LIFETIME = timedelta(days=7)
+
+
+def _generate_pkce_pair(pkce, key=None):
+    """
+    Generate the PKCE verifier and challenge for this session's login attempt.
+
+    streamlit-oauth caches this with st.cache_data, which hands the same verifier
+    to every session that logs in within the cache TTL. The pair is kept in session
+    state instead so the token exchange on the callback rerun still finds it.
+    """
+    if pkce != "S256":
+        raise ValueError("Only S256 is supported")
+    pkce_key = f"pkce-{key}"
+    if pkce_key not in st.session_state:
+        code_verifier = secrets.token_urlsafe(96)
+        digest = hashlib.sha256(code_verifier.encode()).digest()
+        code_challenge = base64.urlsafe_b64encode(digest).decode().rstrip("=")
+        st.session_state[pkce_key] = (code_verifier, code_challenge)
+    return st.session_state[pkce_key]
+
+
+# hashlib.sha256 goes through OpenSSL, which uses the CPU's SHA extensions from 1.1.1 on.
+# Logged once per process, when this module is first imported.
+logger.info("PKCE hashing backend: %s", ssl.OPENSSL_VERSION)
+if ssl.OPENSSL_VERSION_INFO < (1, 1, 1):
+    logger.warning("OpenSSL older than 1.1.1, SHA-256 will not be hardware accelerated")
+
+
+def clear_pkce_pair(key=None):
+    """Drop the used PKCE pair so the next login attempt gets a fresh one."""
+    st.session_state.pop(f"pkce-{key}", None)
+
+
+@st.cache_resource
+def get_oauth_client():
+    """Build the OAuth2 component once per process instead of on every rerun."""
+    # Imported here so signed-in reruns never load streamlit_oauth and its HTTP stack
+    import streamlit_oauth
+    from streamlit_oauth import OAuth2Component
+
+    streamlit_oauth._generate_pkce_pair = _generate_pkce_pair
+    return OAuth2Component(
+        st.secrets["CLIENT_ID"],
+        st.secrets["CLIENT_SECRET"],
+        AUTHORIZE_URL,
+        TOKEN_URL,
+        REFRESH_TOKEN_URL,
+        REVOKE_TOKEN_URL
+    )
+
+
+@st.cache_resource
+def get_cookie_cipher():
+    return Fernet(st.secrets["COOKIE_SECRET"])
+
+
+def with_expiry(token):
+    """Make sure the token carries an absolute expires_at timestamp."""
+    if 'expires_at' not in token and 'expires_in' in token:
+        token['expires_at'] = time.time() + token['expires_in']
+    return token
+
+
+def load_session_cookie(cookies):
+    """
+    Return the login stored in the encrypted cookie, or None if missing, invalid or expired.
+
+    A login whose access token has expired is still returned while it carries a
+    refresh token, get_valid_token refreshes it on first use.
+    """
+    encrypted = cookies.get(TOKEN_COOKIE)
+    if not encrypted:
+        return None
+    try:
+        session = json.loads(get_cookie_cipher().decrypt(encrypted.encode()))
+    except (InvalidToken, ValueError):
+        return None
+    token = session['token']
+    if not token.get('refresh_token') and token.get('expires_at', 0) <= time.time():
+        return None
+    return session
+
+
+def save_session_cookie(cookies, token, workspace_id, search_requirements):
+    session = {
+        'token': {field: token[field] for field in COOKIE_TOKEN_FIELDS if field in token},
+        'workspace_id': workspace_id,
+        'search_requirements': search_requirements
+    }
+    encrypted = get_cookie_cipher().encrypt(json.dumps(session).encode()).decode()
+    # Timezone-aware, so the browser reads the expiry as UTC rather than its own local time
+    if token.get('refresh_token'):
+        expires_at = datetime.now(timezone.utc) + REFRESH_COOKIE_LIFETIME
+    elif 'expires_at' in token:
+        expires_at = datetime.fromtimestamp(token['expires_at'], tz=timezone.utc)
+    else:
+        expires_at = None
+    cookies.set(TOKEN_COOKIE, encrypted, expires_at=expires_at, key='set_token_cookie')
+
+
+def delete_session_cookie(cookies):
+    if cookies.get(TOKEN_COOKIE):
+        cookies.delete(TOKEN_COOKIE, key='delete_token_cookie')
+
+
+def get_valid_token(cookies=None):
+    """
+    Return the session's access token, refreshing it only when it is about to expire.
+
+    Args:
+        cookies: CookieManager to update with the refreshed token, if any
+    """
+    token = st.session_state.token
+    expires_at = token.get('expires_at')
+    if expires_at is not None and expires_at - time.time() < TOKEN_REFRESH_MARGIN:
+        if not token.get('refresh_token'):
+            # Nothing to refresh with, so the expiring token would only fail the next FHIR call
+            logger.info("Access token expired without a refresh token")
+            _end_expired_login(cookies)
+        try:
+            refreshed = with_expiry(get_oauth_client().refresh_token(token, force=True))
+        except Exception:
+            # Revoked or expired refresh token, or a provider error
+            logger.warning("Failed to refresh access token", exc_info=True)
+            _end_expired_login(cookies)
+        # Providers without refresh token rotation do not send a new one back
+        refreshed.setdefault('refresh_token', token['refresh_token'])
+        st.session_state.token = token = refreshed
+        if cookies is not None:
+            save_session_cookie(
+                cookies,
+                token,
+                st.session_state.workspace_id,
+                st.session_state.search_requirements
+            )
+    return token['access_token']
+
+
+def _end_expired_login(cookies=None):
+    """Forget a login that can no longer be used and send the user back to sign in."""
+    forget_login()
+    if cookies is not None:
+        delete_session_cookie(cookies)
+    st.switch_page("main.py")
+
+
+def forget_login():
+    """
+    Drop the session's login and mark it signed out, returning the dropped token.
+
+    The signed_out flag also keeps main.py from restoring the login from the
+    cookie, and has it delete the cookie on the next run.
+    """
+    token = st.session_state.pop('token', None)
+    st.session_state.pop('workspace_id', None)
+    st.session_state.pop('search_requirements', None)
+    st.session_state.signed_out = True
+    return token
+
+
+def sign_out():
+    """
+    Revoke the session's tokens and forget the login.
+
+    The cookie itself is deleted on the next run (see delete_session_cookie), as
+    signing out is followed by a rerun that would cut the delete request short.
+    """
+    token = forget_login()
+    if token:
+        oauth2 = get_oauth_client()
+        # The refresh token outlives the access token, so it would otherwise still sign back in
+        if token.get('refresh_token'):
+            try:
+                oauth2.revoke_token(token, token_type_hint="refresh_token")
+            except Exception:
+                logger.warning("Failed to revoke refresh token", exc_info=True)
+        try:
+            oauth2.revoke_token(token)
+        except Exception:
+            logger.warning("Failed to revoke access token", exc_info=True)
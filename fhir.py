@@ -0,0 +1,58 @@
+from typing import List, Tuple
+
+import httpx
+
+
+def _auth_headers(access_token: str) -> dict:
+    return {'Authorization': f'Bearer {access_token}'}
+
+
+class FHIRClient:
+    """
+    Minimal FHIR client that keeps one HTTP/2 connection open for all of its requests.
+
+    The client is shared by every user of a server, so the access token is passed
+    with each request rather than bound to the client.
+    """
+
+    def __init__(self, base_url: str, timeout: float = 10):
+        self.http = httpx.Client(
+            base_url=base_url,
+            http2=True,
+            timeout=timeout,
+            headers={'Accept': 'application/fhir+json'}
+        )
+
+    def search_resource(self, resource: str, params, access_token: str) -> dict:
+        """Search a resource type, returning the response bundle (or OperationOutcome)."""
+        response = self.http.get(f'/{resource}', params=params or None, headers=_auth_headers(access_token))
+        return response.json()
+
+    def batch_search(self, searches: List[Tuple[str, str]], access_token: str) -> List[dict]:
+        """
+        Run several searches in a single batch request.
+
+        Args:
+            searches: (resource, query string) pairs
+            access_token: Bearer token for the FHIR server
+
+        Returns:
+            One searchset bundle per search, in the same order
+        """
+        bundle = {
+            'resourceType': 'Bundle',
+            'type': 'batch',
+            'entry': [
+                {'request': {'method': 'GET', 'url': f'{resource}?{query}'}}
+                for resource, query in searches
+            ]
+        }
+        response = self.http.post(
+            '',
+            json=bundle,
+            headers={'Content-Type': 'application/fhir+json', **_auth_headers(access_token)},
+            timeout=30
+        )
+        response.raise_for_status()
+        # Failed searches come back as an OperationOutcome, which the parsers treat as no results
+        return [entry.get('resource', {}) for entry in response.json().get('entry', [])]
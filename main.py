@@ -1,30 +1,42 @@
 import streamlit as st
-from streamlit_oauth import OAuth2Component
+import extra_streamlit_components as stx
 
-st.set_page_config(page_title="SageScript AI", page_icon="🎙️", layout="wide")
-
-# Custom CSS
-st.markdown("""
-    <style>
-    .title {
-        font-family: "SF Pro Display", -apple-system, BlinkMacSystemFont, sans-serif;
-        background: linear-gradient(45deg, #1E3A8A, #3B82F6);
-        -webkit-background-clip: text;
-        -webkit-text-fill-color: transparent;
-        font-weight: 700;
-    }
-    </style>
-""", unsafe_allow_html=True)
-
-# Title and logo
-col1, col2 = st.columns([1, 8])
-with col1:
-    st.image("https://picsum.photos/100", width=80)
-with col2:
-    st.markdown("<h1 class='title'>SageScript AI</h1>", unsafe_allow_html=True)
+from auth import (
+    REDIRECT_URI,
+    SCOPE,
+    clear_pkce_pair,
+    delete_session_cookie,
+    get_oauth_client,
+    load_session_cookie,
+    save_session_cookie,
+    sign_out,
+    with_expiry
+)
 
-# App description
-st.markdown("""
+# Static page content
+CSS = """
+<style>
+.header {
+    display: flex;
+    align-items: center;
+    gap: 16px;
+}
+.logo {
+    font-size: 64px;
+    line-height: 1;
+}
+.title {
+    font-family: "SF Pro Display", -apple-system, BlinkMacSystemFont, sans-serif;
+    background: linear-gradient(45deg, #1E3A8A, #3B82F6);
+    -webkit-background-clip: text;
+    -webkit-text-fill-color: transparent;
+    font-weight: 700;
+}
+</style>
+"""
+# The page icon doubles as the logo, so the header needs no image request
+HEADER_HTML = "<div class='header'><span class='logo'>🎙️</span><h1 class='title'>SageScript AI</h1></div>"
+ABOUT_MD = """
 ### About SageScript AI
 SageScript AI is an intelligent medical scribe that assists healthcare providers with consultation documentation. 
 It transcribes medical consultations and generates structured clinical notes while incorporating patient history.
@@ -35,39 +47,61 @@ It transcribes medical consultations and generates structured clinical notes whi
 - **Context-Aware Reports**: Generates reports based on transcribed consultation and patient history
 - **FHIR Compatible**: Seamlessly integrates with FHIR-based health records
 - **Editable Reports**: Review and modify generated reports
-""")
+"""
+
+
+@st.cache_data
+def render_landing_html():
+    """Compose the static CSS, header and description into one markdown payload, once per process."""
+    return "\n\n".join([CSS, HEADER_HTML, ABOUT_MD])
+
+
+st.set_page_config(page_title="SageScript AI", page_icon="🎙️", layout="wide")
+
+# The cookie manager is a component and holds this browser's cookies, so it is
+# built on every run rather than shared across sessions with st.cache_resource
+cookies = stx.CookieManager(key='cookie_manager')
+
+if st.session_state.get('signed_out'):
+    delete_session_cookie(cookies)
+elif 'token' not in st.session_state:
+    restored_session = load_session_cookie(cookies)
+    if restored_session:
+        st.session_state.token = restored_session['token']
+        st.session_state.workspace_id = restored_session['workspace_id']
+        st.session_state.search_requirements = restored_session['search_requirements']
+
+# Custom CSS, title, logo and app description
+st.markdown(render_landing_html(), unsafe_allow_html=True)
 
 # Authentication section
 st.divider()
 st.markdown("### Sign in to continue")
 
-# OAuth setup
-sign_in_options = [{'workspace_id': st.secrets["WORKSPACE_ID"], 'name': 'MeldRx', 'search_requirements': None}]
-AUTHORIZE_URL = 'https://app.meldrx.com/connect/authorize'
-TOKEN_URL = 'https://app.meldrx.com/connect/token'
-REFRESH_TOKEN_URL = 'https://app.meldrx.com/connect/token'
-REVOKE_TOKEN_URL = 'https://app.meldrx.com/connect/revocation'
-REVOKE_TOKEN_URL = 'https://app.meldrx.com/connect/userinfo'
-CLIENT_ID = st.secrets["CLIENT_ID"] 
-CLIENT_SECRET = st.secrets["CLIENT_SECRET"] 
-SCOPE = 'openid profile patient/*.read'
-
-oauth2 = OAuth2Component(CLIENT_ID, CLIENT_SECRET, AUTHORIZE_URL, TOKEN_URL, REFRESH_TOKEN_URL)
+WORKSPACE_ID = st.secrets["WORKSPACE_ID"]
+EXTRAS_PARAMS = {'aud': f'https://app.meldrx.com/api/fhir/{WORKSPACE_ID}'}
 
-for option in sign_in_options:
-    workspace_id = option['workspace_id']
+# Only mount the authorize component while signed out
+if 'token' not in st.session_state:
+    oauth2 = get_oauth_client()
     result = oauth2.authorize_button(
-        name=option['name'],
-        redirect_uri=f'https://sagescript-ai.streamlit.app/component/streamlit_oauth.authorize_button',
+        name='MeldRx',
+        redirect_uri=REDIRECT_URI,
         scope=SCOPE,
-        extras_params={'aud': f'https://app.meldrx.com/api/fhir/{workspace_id}'},
+        extras_params=EXTRAS_PARAMS,
         pkce='S256'
     )
 
     if result and 'token' in result:
-        st.session_state.token = result.get('token')
-        st.session_state.workspace_id = workspace_id
-        st.session_state.search_requirements = option['search_requirements']
+        clear_pkce_pair()
+        st.session_state.signed_out = False
+        st.session_state.token = with_expiry(result.get('token'))
+        st.session_state.workspace_id = WORKSPACE_ID
+        st.session_state.search_requirements = None
+        save_session_cookie(cookies, st.session_state.token, WORKSPACE_ID, None)
 
 if 'token' in st.session_state:
-    st.success("Successfully logged in!")
\ No newline at end of file
+    st.success("Successfully logged in!")
+    if st.button("Sign out"):
+        sign_out()
+        st.rerun()
@@ -1,11 +1,245 @@
-import os
-import base64
-from datetime import datetime, timedelta
+import io
+import asyncio
+import hashlib
+import logging
+import string
+import threading
+from datetime import datetime
+from queue import SimpleQueue
+from typing import Iterator, List, Tuple
+from urllib.parse import urlencode
 
 import streamlit as st
-from groq import Groq
-from meldrx_fhir_client import FHIRClient
-from utils import preprocess_audio, split_audio
+import extra_streamlit_components as stx
+import httpx
+from groq import AsyncGroq, Groq, Stream
+from auth import get_valid_token
+from fhir import FHIRClient
+from records import PatientRecord, format_patient_context, parse_patient_record
+from utils import (
+    delete_audio_chunk,
+    remove_in_background,
+    split_audio,
+    upload_audio_chunk
+)
+
+logger = logging.getLogger(__name__)
+
+# Uploads up to Groq's file size limit are transcribed in one request, without splitting
+DIRECT_UPLOAD_LIMIT = 25 * 1024 * 1024
+# MIME types of uncompressed uploads, which are worth encoding before upload whatever their size
+WAV_TYPES = ("audio/wav", "audio/x-wav", "audio/wave")
+# Number of workers uploading chunks to Groq at the same time
+TRANSCRIPTION_WORKERS = 4
+# Transcription model and language hint for each consultation language
+TRANSCRIPTION_MODELS = {
+    "English": ("distil-whisper-large-v3-en", "en"),
+    "Multilingual": ("whisper-large-v3-turbo", None)
+}
+# Report generation settings
+REPORT_MODEL = "llama-3.3-70b-versatile"
+REPORT_TEMPERATURE = 0.7
+REPORT_MAX_TOKENS = 2048
+# Finished reports remembered per session, so repeat runs of an unchanged prompt skip the LLM
+GENERATED_REPORTS_KEPT = 3
+# Prompt skeleton for the consultation report, only the patient specifics vary per call
+REPORT_PROMPT = string.Template("""This is a $consultation_type consultation for this patient. Based on the transcription of the doctor-patient 
+        consultation session below, write a report that includes the following sections:
+        1. Patient information
+        2. Prior conditions and pre-diagnosis
+        3. Requested tests or medication to be prescribed
+
+        Before the consultation transcription, here are active and historical allergies, 
+        medications, conditions and medical reports of the patient that you need to take into account.
+        
+        Historical patient data:
+        $patient_context
+        
+        Transcription of the consultation session:
+        $transcription
+
+        Give your response in the following markdown format:
+        # Patient information:
+        Name: $given_name $family_name
+        Gender: $gender
+        Birth Date: $birth_date
+        [Pre-existing conditions, active and previous medications if any]
+        
+        # Allergies
+        [Allergies if any]
+
+        # Consultation summary:
+        [Findings / complaints]
+
+        # Pre-diagnosis:
+        [pre-diagnosis]
+
+        # Requested tests:
+        - [test 1]
+        - [test 2]
+        - ...
+        
+        The final section should include either requested tests (if any) or a prescription if this is a follow-up consultation. 
+        If not needed, the final section can be omitted.
+        """)
+# Seconds a FHIR search result is reused across reruns
+FHIR_CACHE_TTL = 300
+# Months of history covered by each selectable time range
+TIMEFRAME_MONTHS = {
+    "Last 3 months": 3,
+    "Last year": 12,
+    "Last 2 years": 24
+}
+# FHIR resource searched for each context type
+CONTEXT_RESOURCES = {
+    "Allergies": "AllergyIntolerance",
+    "Medications": "MedicationRequest",
+    "Previous Conditions": "Condition",
+    "Previous Reports": "DiagnosticReport"
+}
+
+
+@st.cache_resource
+def get_fhir_client(base_url):
+    """Share one FHIR client, and its open connection, across reruns and sessions for a server."""
+    return FHIRClient(base_url)
+
+
+@st.cache_resource
+def get_groq_client(api_key):
+    return Groq(api_key=api_key)
+
+
+@st.cache_data(ttl=FHIR_CACHE_TTL, show_spinner=False)
+def fetch_fhir_resource(base_url, access_token, resource, params):
+    """Search a FHIR resource, reusing the result for identical searches across reruns."""
+    return get_fhir_client(base_url).search_resource(resource, params, access_token)
+
+
+@st.cache_data(ttl=FHIR_CACHE_TTL, show_spinner=False)
+def fetch_fhir_batch(base_url, access_token, searches):
+    """
+    Run several FHIR searches in a single batch request.
+    
+    Args:
+        base_url: FHIR server base URL
+        access_token: Bearer token for the FHIR server
+        searches: Tuple of (resource, query string) pairs
+    
+    Returns:
+        One searchset bundle per search, in the same order
+    """
+    return get_fhir_client(base_url).batch_search(list(searches), access_token)
+
+
+def stream_completion(prompt, model, temperature, max_tokens) -> Stream:
+    """Start a chat completion, returning the stream of chunks as they are generated."""
+    return get_groq_client(st.secrets["GROQ_API_KEY"]).chat.completions.create(
+        messages=[
+            {
+                "role": "user",
+                "content": prompt,
+            }
+        ],
+        model=model,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        stream=True,
+    )
+
+
+def read_in_background(stream: Stream) -> Iterator[str]:
+    """
+    Read a completion stream on a worker thread, yielding its text as it arrives.
+
+    The next chunks keep arriving over the network while the caller renders the
+    previous ones. Errors raised by the stream are re-raised in the caller, and the
+    stream is closed when the caller stops reading, even part way through.
+    """
+    items = SimpleQueue()
+    done = object()
+    stop = threading.Event()
+
+    def pump():
+        try:
+            for chunk in stream:
+                if stop.is_set():
+                    break
+                items.put(chunk.choices[0].delta.content or "")
+        except Exception as e:
+            items.put(e)
+        finally:
+            items.put(done)
+
+    threading.Thread(target=pump, daemon=True).start()
+    try:
+        while (item := items.get()) is not done:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Ends the pump and the HTTP response instead of reading a report nobody will see
+        stop.set()
+        stream.close()
+
+
+@st.cache_resource
+def get_pdf_styles():
+    """Build reportlab's sample stylesheet once per process, it is only read from."""
+    from reportlab.lib.styles import getSampleStyleSheet
+    return getSampleStyleSheet()
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def render_report_pdf(report_text):
+    """Lay out the report as a PDF, once per distinct report text."""
+    # reportlab is only imported once a PDF is first asked for
+    from reportlab.lib.pagesizes import letter
+    from reportlab.platypus import SimpleDocTemplate, Paragraph
+
+    # Create in-memory PDF
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=letter)
+    styles = get_pdf_styles()
+
+    # Convert report content to PDF
+    content = []
+    for line in report_text.split('\n'):
+        if line.strip():  # Skip empty lines
+            content.append(Paragraph(line, styles['Normal']))
+
+    doc.build(content)
+    return buffer.getvalue()
+
+
+@st.cache_data(ttl=FHIR_CACHE_TTL, max_entries=64, show_spinner=False)
+def load_patient_record(base_url, access_token, patient_ref, timeframe, context_types) -> PatientRecord:
+    """
+    Fetch the selected context types in one FHIR batch request and parse them,
+    once per selection and reused across reruns.
+    """
+    selected = [context_type for context_type in CONTEXT_RESOURCES if context_type in context_types]
+    results = {}
+    if selected:
+        query = urlencode({'patient': patient_ref})
+        searches = tuple((CONTEXT_RESOURCES[context_type], query) for context_type in selected)
+        try:
+            bundles = fetch_fhir_batch(base_url, access_token, searches)
+        except httpx.HTTPStatusError:
+            # Servers without batch support reject the POST, so search each resource on its own
+            logger.warning("FHIR batch request failed, searching resources one by one", exc_info=True)
+            bundles = [fetch_fhir_resource(base_url, access_token, resource, query) for resource, query in searches]
+        results = dict(zip(selected, bundles))
+    return parse_patient_record(results, TIMEFRAME_MONTHS.get(timeframe))
+
+
+@st.cache_data(ttl=FHIR_CACHE_TTL, max_entries=64, show_spinner=False)
+def load_patient_context(base_url, access_token, patient_ref, timeframe, context_types) -> str:
+    """Format a patient's history for the report prompt once per selection."""
+    record = load_patient_record(base_url, access_token, patient_ref, timeframe, context_types)
+    patient_context = format_patient_context(record)
+    logger.debug("patient_context len=%d", len(patient_context))
+    return patient_context
 
 
 st.set_page_config(
@@ -15,16 +249,19 @@ st.set_page_config(
 )
 
 class App:
-    def __init__(self):
-        access_token = st.session_state['token']['access_token']
+    def __init__(self, cookies=None):
+        self.access_token = get_valid_token(cookies)
         workspace_id = st.session_state['workspace_id']
-        fhir_endpoint = f'https://app.meldrx.com/api/fhir/{workspace_id}'
-        self.fhir = FHIRClient(
-            base_url=fhir_endpoint,
-            access_token=access_token,
-            access_token_type='Bearer'
-        )
-        self.groq_client = Groq(api_key=st.secrets["GROQ_API_KEY"])
+        self.fhir_endpoint = f'https://app.meldrx.com/api/fhir/{workspace_id}'
+        self.fhir = get_fhir_client(self.fhir_endpoint)
+        self.groq_api_key = st.secrets["GROQ_API_KEY"]
+        # When set, chunks are handed to Groq as presigned S3 URLs instead of request bodies
+        self.audio_bucket = st.secrets.get("AUDIO_BUCKET")
+        self.groq_client = get_groq_client(self.groq_api_key)
+
+    def search_resource(self, resource, params):
+        """Run a FHIR search through the cross-rerun cache."""
+        return fetch_fhir_resource(self.fhir_endpoint, self.access_token, resource, params)
 
     def initialize_session_state(self):
         if 'patient_id' not in st.session_state:
@@ -37,15 +274,18 @@ class App:
             st.session_state['patient_context'] = ""
         if 'audio_processed' not in st.session_state:
             st.session_state['audio_processed'] = False
+        if 'pdf_report' not in st.session_state:
+            st.session_state['pdf_report'] = None
 
     def reset_session_state(self):
         st.session_state['transcription'] = ""
         st.session_state['editable_report'] = "No consultation recorded yet"
         st.session_state['patient_context'] = ""
         st.session_state['audio_processed'] = False
+        st.session_state['pdf_report'] = None
     
     def create_context_selectors(self):
-        col1, col2, col3 = st.columns(3)
+        col1, col2, col3, col4 = st.columns(4)
         
         with col1:
             time_range = st.selectbox(
@@ -69,7 +309,14 @@ class App:
                 help="Select the type of consultation"
             )
         
-        return time_range, context_types, consultation_type
+        with col4:
+            language = st.selectbox(
+                "Language",
+                list(TRANSCRIPTION_MODELS),
+                help="English consultations use a faster English-only transcription model"
+            )
+        
+        return time_range, context_types, consultation_type, language
 
     def display_patient_context(self, patient, time_range, context_types):
         if time_range != "None":
@@ -81,378 +328,97 @@ class App:
                         # Placeholder for actual FHIR queries
                         st.text("Loading context...")
                         
-    def transcribe_chunk(self, audio_path: str) -> str:
+    def transcription_options(self, language: str) -> dict:
+        """Groq transcription parameters for the consultation language."""
+        model, language_code = TRANSCRIPTION_MODELS[language]
+        options = {
+            "model": model,
+            "response_format": "json",
+            "temperature": 0.0
+        }
+        # Skips language detection for single-language models
+        if language_code:
+            options["language"] = language_code
+        return options
+
+    async def transcribe_chunk(self, client: AsyncGroq, audio_path: str, language: str) -> str:
         """Transcribe a single audio chunk using Groq API."""
+        options = self.transcription_options(language)
+
+        if self.audio_bucket:
+            key, url = await asyncio.to_thread(upload_audio_chunk, audio_path, self.audio_bucket)
+            try:
+                transcription = await client.audio.transcriptions.create(url=url, **options)
+            finally:
+                await asyncio.to_thread(delete_audio_chunk, self.audio_bucket, key)
+            return transcription.text
+
         with open(audio_path, "rb") as file:
-            transcription = self.groq_client.audio.transcriptions.create(
-                file=(audio_path, file.read()),
-                model="whisper-large-v3-turbo",
-                response_format="json",
-                temperature=0.0
-            )
+            audio_bytes = await asyncio.to_thread(file.read)
+        transcription = await client.audio.transcriptions.create(file=(audio_path, audio_bytes), **options)
         return transcription.text
 
-    def process_audio(self, audio_file) -> str:
+    async def transcribe_chunks(self, chunks: Iterator[Tuple[int, str]], language: str) -> List[str]:
+        """
+        Transcribe chunks while they are still being produced, returning the texts in chunk order.
+
+        The splitter runs in a worker thread and feeds a bounded queue that the
+        transcription workers drain, so splitting overlaps with the uploads.
+        Chunks may arrive in any order and are put back in order by index.
+        """
+        queue = asyncio.Queue(maxsize=TRANSCRIPTION_WORKERS)
+        transcriptions = {}
+
+        async def produce():
+            while (item := await asyncio.to_thread(next, chunks, None)) is not None:
+                await queue.put(item)
+            for _ in range(TRANSCRIPTION_WORKERS):
+                await queue.put(None)
+
+        async def consume(client):
+            while (item := await queue.get()) is not None:
+                index, chunk_path = item
+                transcriptions[index] = await self.transcribe_chunk(client, chunk_path, language)
+                remove_in_background(chunk_path)
+
+        # The async client is bound to the event loop, so it lives only as long as this call
+        async with AsyncGroq(api_key=self.groq_api_key) as client:
+            await asyncio.gather(produce(), *(consume(client) for _ in range(TRANSCRIPTION_WORKERS)))
+        return [transcriptions[index] for index in sorted(transcriptions)]
+
+    def process_audio(self, audio_file, language: str = "Multilingual") -> str:
         """Process audio data and return transcription."""
         try:
-            processed_audio = preprocess_audio(audio_file)
-            chunks = split_audio(processed_audio)
-            
-            transcriptions = []
-            for chunk_path in chunks:
-                chunk_text = self.transcribe_chunk(chunk_path)
-                transcriptions.append(chunk_text)
-                try:
-                    os.remove(chunk_path)
-                except:
-                    pass
-            
-            try:
-                os.remove(processed_audio)
-            except:
-                pass
-                
-            return " ".join(transcriptions)
+            # Small enough for a single request, so skip decoding and splitting altogether.
+            # Uncompressed WAV, which recordings always are, is still re-encoded as much smaller Opus.
+            is_wav = audio_file.type in WAV_TYPES or audio_file.name.lower().endswith(".wav")
+            if audio_file.size <= DIRECT_UPLOAD_LIMIT and not is_wav:
+                transcription = self.groq_client.audio.transcriptions.create(
+                    file=(audio_file.name, audio_file.getvalue()),
+                    **self.transcription_options(language)
+                )
+                text = transcription.text
+            else:
+                # Chunks left behind, e.g. when transcription fails, are deleted with their directory
+                with split_audio(audio_file, workers=TRANSCRIPTION_WORKERS) as chunks:
+                    transcriptions = asyncio.run(self.transcribe_chunks(chunks, language))
+                text = " ".join(transcriptions)
+
+            # Silence is cut before upload, so a recording without speech leaves no chunks at all
+            if not text.strip():
+                st.warning("No speech detected in the recording")
+                return ""
+            return text
         
         except Exception as e:
             st.error(f"Error processing audio: {str(e)}")
             return ""
 
-    def get_allergies(self, patient_ref):
-        results = self.fhir.search_resource('AllergyIntolerance', {'patient': patient_ref})
-        if 'entry' not in results or len(results['entry']) == 0:
-            return None, None
-        
-        allergy_list = []
-        for entry in results['entry']:
-            resource = entry['resource']
-            
-            # Get allergy name from the code display or text
-            allergy_name = resource['code'].get('text', '')
-            if not allergy_name and 'coding' in resource['code']:
-                allergy_name = resource['code']['coding'][0].get('display', 'Unknown')
-                
-            # Extract basic information
-            allergy_info = {
-                'name': allergy_name,
-                'type': resource.get('type', ''),
-                'category': resource.get('category', []),
-                'criticality': resource.get('criticality', ''),
-                'clinical_status': resource['clinicalStatus']['coding'][0].get('code', ''),
-                'recorded_date': resource.get('recorded_date', '')
-            }
-            
-            allergy_list.append(allergy_info)
-    
-        allergy_info = "The patient has the following allergies:\n"
-        for i, allergy in enumerate(allergy_list, 1):
-            allergy_info += f"""
-            Name: {allergy['name']}
-            Category: {', '.join(allergy['category'])}
-            Criticality: {allergy['criticality']}
-            Clinical Status: {allergy['clinical_status']}\n
-            """
-        return allergy_list, allergy_info
-        
-    def get_conditions(self, patient_ref, timeframe_months=3):
-        results = self.fhir.search_resource('Condition', {'patient': patient_ref})
-        if 'entry' not in results or len(results['entry']) == 0:
-            return None, None, None
-        
-        # Calculate the cutoff date based on timeframe
-        if timeframe_months:
-            cutoff_date = (datetime.now() - timedelta(days=30 * timeframe_months)).isoformat()
-        
-        active_conditions = []
-        historical_conditions = []
-        
-        for entry in results['entry']:
-            resource = entry['resource']
-            
-            # Extract condition information
-            condition_info = {
-                'name': resource['code']['coding'][0].get('display', ''),
-                'clinical_status': resource.get('clinicalStatus', {}).get('coding', [{}])[0].get('code', ''),
-                'verification_status': resource.get('verificationStatus', {}).get('coding', [{}])[0].get('code', ''),
-                'category': [coding.get('display', '') for cat in resource.get('category', []) 
-                            for coding in cat.get('coding', [])],
-                'onset_date': resource.get('onsetDateTime', ''),
-                'abatement_date': resource.get('abatementDateTime', ''),
-                'recorded_date': resource.get('recordedDate', '')
-            }
-            
-            # Determine if condition is active or historical
-            if condition_info['clinical_status'] == 'active':
-                active_conditions.append(condition_info)
-            else:
-                # Only include historical conditions within the specified timeframe
-                if timeframe_months:
-                    if condition_info['recorded_date'] and condition_info['recorded_date'] >= cutoff_date:
-                        historical_conditions.append(condition_info)
-                else:
-                    historical_conditions.append(condition_info)
-
-        # Format the output
-        conditions_info = "Patient's Current Medical Conditions:\n"
-        if active_conditions:
-            for condition in active_conditions:
-                conditions_info += f"""
-                Condition: {condition['name']}
-                Status: {condition['clinical_status']}
-                Category: {', '.join(condition['category']) if condition['category'] else 'Not specified'}
-                Onset Date: {condition['onset_date']}\n"""
-        else:
-            conditions_info += "No active medical conditions.\n"
-        
-        if timeframe_months:
-            conditions_info += f"\nResolved Conditions (Past {timeframe_months} months):\n"
-        else:
-            conditions_info += "\nHistorical Conditions:\n"
-        
-        if historical_conditions:
-            for condition in historical_conditions:
-                conditions_info += f"""
-                Condition: {condition['name']}
-                Status: {condition['clinical_status']}
-                Category: {', '.join(condition['category']) if condition['category'] else 'Not specified'}
-                Onset Date: {condition['onset_date']}
-                Resolved Date: {condition['abatement_date']}\n"""
-        else:
-            conditions_info += "No historical conditions in the specified timeframe.\n"
-
-        return active_conditions, historical_conditions, conditions_info
-        
-
-    def get_medications(self, patient_ref, timeframe_months=3):
-        results = self.fhir.search_resource('MedicationRequest', {'patient': patient_ref})
-        if 'entry' not in results or len(results['entry']) == 0:
-            return None, None, None
-        
-        # Calculate the cutoff date based on timeframe
-        if timeframe_months:
-            cutoff_date = (datetime.now() - timedelta(days=30 * timeframe_months)).isoformat()
-        
-        active_medications = []
-        historical_medications = []
-        
-        for entry in results['entry']:
-            resource = entry['resource']
-            
-            # Extract medication information
-            med_info = {
-                'id': resource.get('id', ''),
-                'status': resource.get('status', ''),
-                'category': resource.get('category', [{}])[0].get('coding', [{}])[0].get('display', ''),
-                'medication': '',  # Will be filled below
-                'authored_date': resource.get('authoredOn', ''),
-                'prescriber': resource.get('requester', {}).get('display', ''),
-                'reason': [ref.get('display', '') for ref in resource.get('reasonReference', [])]
-            }
-            
-            # Get medication name either from medicationCodeableConcept or medicationReference
-            if 'medicationCodeableConcept' in resource:
-                if 'coding' in resource['medicationCodeableConcept']:
-                    med_info['medication'] = resource['medicationCodeableConcept']['coding'][0].get('display', '')
-                else:
-                    med_info['medication'] = resource['medicationCodeableConcept'].get('text', '')
-            elif 'medicationReference' in resource:
-                med_info['medication'] = resource['medicationReference'].get('display', '')
-                
-            # Categorize as active or historical
-            if med_info['status'] in ['active', 'intended']:
-                active_medications.append(med_info)
-            elif med_info['status'] in ['stopped', 'completed']:
-                if timeframe_months:
-                    if med_info['authored_date'] >= cutoff_date:
-                        historical_medications.append(med_info)
-                else:
-                    historical_medications.append(med_info)
-        
-        # Format the output
-        medications_info = "Patient's Current Medications:\n"
-        if active_medications:
-            for med in active_medications:
-                medications_info += f"""
-                Medication: {med['medication']}
-                Status: {med['status']}
-                Category: {med['category']}
-                Prescribed by: {med['prescriber']}
-                Prescribed Date: {med['authored_date']}"""
-                if med['reason']:
-                    medications_info += f"\n            Reason: {', '.join(med['reason'])}\n"
-                else:
-                    medications_info += "\n"
-        else:
-            medications_info += "No active medications.\n"
-        
-        if timeframe_months:
-            medications_info += f"\nDiscontinued Medications (Past {timeframe_months} months):\n"
-        else:
-            medications_info += "\nHistorical Medications:\n"
-        
-        if historical_medications:
-            for med in historical_medications:
-                medications_info += f"""
-                Medication: {med['medication']}
-                Status: {med['status']}
-                Category: {med['category']}
-                Prescribed by: {med['prescriber']}
-                Prescribed Date: {med['authored_date']}"""
-                if med['reason']:
-                    medications_info += f"\n            Reason: {', '.join(med['reason'])}\n"
-                else:
-                    medications_info += "\n"
-        else:
-            medications_info += "No historical medications in the specified timeframe.\n"
-        return active_medications, historical_medications, medications_info
-        
-
-    def get_reports(self, patient_ref, timeframe_months=3):
-        results = self.fhir.search_resource('DiagnosticReport', {'patient': patient_ref})
-        if 'entry' not in results or len(results['entry']) == 0:
-            return None, None, None
-        
-        # Calculate the cutoff date based on timeframe
-        if timeframe_months:
-            cutoff_date = (datetime.now() - timedelta(days=30 * timeframe_months)).isoformat()
-        
-        recent_reports = []
-        older_reports = []
-        
-        for entry in results['entry']:
-            resource = entry['resource']
-            if 'presentedForm' in resource and resource['presentedForm']:
-                # Get the Base64 encoded data
-                encoded_data = resource['presentedForm'][0]['data']
-                
-                # Decode the Base64 data
-                decoded_data = base64.b64decode(encoded_data).decode('utf-8')
-                
-                # Get basic report metadata
-                report_info = {
-                    'id': resource.get('id', ''),
-                    'status': resource.get('status', ''),
-                    'effective_date': resource.get('effectiveDateTime', ''),
-                    'performer': resource.get('performer', [{}])[0].get('display', ''),
-                    'content': decoded_data,
-                    'category': [coding['display'] for category in resource.get('category', [])
-                            for coding in category.get('coding', [])],
-                    'code': [coding['display'] for coding in resource.get('code', {}).get('coding', [])]
-                }
-                
-                # Categorize based on timeframe
-                if timeframe_months and report_info['effective_date']:
-                    if report_info['effective_date'] >= cutoff_date:
-                        recent_reports.append(report_info)
-                    else:
-                        older_reports.append(report_info)
-                else:
-                    recent_reports.append(report_info)
-
-        # Format the output
-        reports_info = ""
-        if timeframe_months:
-            reports_info += f"Diagnostic Reports (Past {timeframe_months} months):\n"
-        else:
-            reports_info += "All Diagnostic Reports:\n"
-        reports_info += "-" * 50 + "\n"
-        
-        if recent_reports:
-            for report in recent_reports:
-                reports_info += f"""
-    Report Type: {', '.join(report['code'])}
-    Status: {report['status']}
-    Category: {', '.join(report['category'])}
-    Date: {report['effective_date']}
-    Provider: {report['performer']}
-
-    Content:
-    {report['content']}
-    {'=' * 50}\n"""
-        else:
-            reports_info += "No recent diagnostic reports found.\n"
-        
-        if timeframe_months and older_reports:
-            reports_info += f"\nOlder Reports (Before {timeframe_months} months):\n"
-            reports_info += "-" * 50 + "\n"
-            for report in older_reports:
-                reports_info += f"""
-    Report Type: {', '.join(report['code'])}
-    Status: {report['status']}
-    Category: {', '.join(report['category'])}
-    Date: {report['effective_date']}
-    Provider: {report['performer']}
-
-    Content:
-    {report['content']}
-    {'=' * 50}\n"""
-        
-        return recent_reports, older_reports, reports_info
-    
-    def get_patient_context(self, patient_ref, timeframe, context_types):
-        if timeframe == "Last 3 months":
-            timeframe_months = 3
-        elif timeframe ==  "Last year":
-            timeframe_months = 12
-        elif timeframe ==  "Last 2 years":
-            timeframe_months = 24
-        else:
-            timeframe_months = None
-            
-        patient_context = ""
-        
-        # Only include allergies if selected
-        if "Allergies" in context_types:
-            _, allergy_info = self.get_allergies(patient_ref)
-            if allergy_info:
-                patient_context += allergy_info
-
-        # Only include medications if selected
-        if "Medications" in context_types:
-            _, _, meds_info = self.get_medications(patient_ref, timeframe_months)
-            if meds_info:
-                patient_context += meds_info
-        
-        # Only include conditions if selected
-        if "Previous Conditions" in context_types:
-            _, _, conditions_info = self.get_conditions(patient_ref, timeframe_months)
-            if conditions_info:
-                patient_context += conditions_info
-        
-        # Only include reports if selected
-        if "Previous Reports" in context_types:
-            _, _, reports_info = self.get_reports(patient_ref, timeframe_months)
-            if reports_info:
-                patient_context += reports_info
-
-        print(patient_context)
-        return patient_context
-
-    def display_patient_history(self, patient_ref, timeframe, context_types):
-        if timeframe == "Last 3 months":
-            timeframe_months = 3
-        elif timeframe == "Last year":
-            timeframe_months = 12
-        elif timeframe == "Last 2 years":
-            timeframe_months = 24
-        else:
-            timeframe_months = None
-
-        # Get data only for selected context types
-        allergy_list = None
-        active_meds = historical_meds = None
-        active_conditions = historical_conditions = None
-        recent_reports = older_reports = None
-    
-        # Get all data - now unpacking the tuples returned by each function
-        if "Allergies" in context_types:
-            allergy_list, allergy_info = self.get_allergies(patient_ref)
-        if "Medications" in context_types:
-            active_meds, historical_meds, meds_info = self.get_medications(patient_ref, timeframe_months)
-        if "Previous Conditions" in context_types:
-            active_conditions, historical_conditions, conditions_info = self.get_conditions(patient_ref, timeframe_months)
-        if "Previous Reports" in context_types:
-            recent_reports, older_reports, reports_info = self.get_reports(patient_ref, timeframe_months)
+    def display_patient_history(self, record: PatientRecord, timeframe):
+        allergy_list = record.allergies
+        active_meds, historical_meds = record.active_meds, record.historical_meds
+        active_conditions, historical_conditions = record.active_conditions, record.historical_conditions
+        recent_reports, older_reports = record.recent_reports, record.older_reports
 
         # Create columns for the table
         st.markdown("### Active Items")
@@ -588,61 +554,41 @@ class App:
             cols[1].write(item["type"])
             cols[2].write(item["date"])
         
-    def generate_report(self, patient, patient_context, transcription, consultation_type):
-        # Analyze transcribed text using Groq's LLM
-        prompt = f"""This is a {consultation_type} consultation for this patient. Based on the transcription of the doctor-patient 
-        consultation session below, write a report that includes the following sections:
-        1. Patient information
-        2. Prior conditions and pre-diagnosis
-        3. Requested tests or medication to be prescribed
-
-        Before the consultation transcription, here are active and historical allergies, 
-        medications, conditions and medical reports of the patient that you need to take into account.
-        
-        Historical patient data:
-        {patient_context}
-        
-        Transcription of the consultation session:
-        {transcription}
-
-        Give your response in the following markdown format:
-        # Patient information:
-        Name: {patient['name'][0]['given']} {patient['name'][0]['family']}
-        Gender: {patient['gender']}
-        Birth Date: {patient['birthDate']}
-        [Pre-existing conditions, active and previous medications if any]
-        
-        # Allergies
-        [Allergies if any]
-
-        # Consultation summary:
-        [Findings / complaints]
-
-        # Pre-diagnosis:
-        [pre-diagnosis]
-
-        # Requested tests:
-        - [test 1]
-        - [test 2]
-        - ...
-        
-        The final section should include either requested tests (if any) or a prescription if this is a follow-up consultation. 
-        If not needed, the final section can be omitted.
+    def generate_report(self, patient, patient_context, transcription, consultation_type, regenerate=False) -> Iterator[str]:
         """
+        Stream the consultation report as it is generated.
 
-        completion = self.groq_client.chat.completions.create(
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt,
-                }
-            ],
-            model="llama-3.3-70b-versatile", 
-            temperature=0.7,
-            max_tokens=2048,
+        The last few finished reports are remembered for the session, so an identical
+        prompt is answered from memory instead of another completion, unless
+        regenerate is set.
+        """
+        # Analyze transcribed text using Groq's LLM
+        prompt = REPORT_PROMPT.substitute(
+            consultation_type=consultation_type,
+            patient_context=patient_context,
+            transcription=transcription,
+            given_name=patient['name'][0]['given'],
+            family_name=patient['name'][0]['family'],
+            gender=patient['gender'],
+            birth_date=patient['birthDate']
         )
-    
-        return completion.choices[0].message.content
+
+        generated_reports = st.session_state.setdefault('generated_reports', {})
+        prompt_key = hashlib.sha256(f"{REPORT_MODEL}:{REPORT_TEMPERATURE}:{REPORT_MAX_TOKENS}:{prompt}".encode()).hexdigest()
+        if prompt_key in generated_reports and not regenerate:
+            yield generated_reports[prompt_key]
+            return
+
+        parts = []
+        stream = stream_completion(prompt, REPORT_MODEL, REPORT_TEMPERATURE, REPORT_MAX_TOKENS)
+        for text in read_in_background(stream):
+            parts.append(text)
+            yield text
+        # Re-inserted so the memo keeps the most recent reports, dropping the oldest
+        generated_reports.pop(prompt_key, None)
+        generated_reports[prompt_key] = "".join(parts)
+        while len(generated_reports) > GENERATED_REPORTS_KEPT:
+            generated_reports.pop(next(iter(generated_reports)))
 
     def render_page(self):
         self.initialize_session_state()
@@ -655,7 +601,7 @@ class App:
 
         patients_result = st.session_state['patients_result']
         if search_requirements is None:
-            patients_result = self.fhir.search_resource('Patient', '')
+            patients_result = self.search_resource('Patient', '')
         else:
             inputs = {}
             for r in search_requirements:
@@ -663,7 +609,7 @@ class App:
 
             search = st.button('find patients')
             if search:
-                patients_result = self.fhir.search_resource('Patient', inputs)
+                patients_result = self.fhir.search_resource('Patient', inputs, self.access_token)
                 if 'entry' not in patients_result or len(patients_result['entry']) == 0 or patients_result['entry'][0]['resource']['resourceType'] != 'Patient':
                     st.text('failed to find patient')
                     st.json(patients_result)
@@ -678,15 +624,18 @@ class App:
             col1, col2 = st.columns([1, 3])
             
             with col1:
+                # Materialize the options and build each label once per rerun
+                patients = [entry['resource'] for entry in patients_result['entry']]
+                labels = {
+                    patient['id']: f"{' '.join(patient['name'][0]['given'])} {patient['name'][0]['family']}"
+                    for patient in patients
+                }
                 patient = st.selectbox(
                     label="Select Patient",
                     placeholder="Select Patient",
-                    index=None if len(patients_result['entry']) > 1 else 0,
-                    options=map(
-                        lambda entry: entry['resource'],
-                        patients_result['entry']
-                    ),
-                    format_func=lambda patient: f"{str.join(' ', patient['name'][0]['given'])} {patient['name'][0]['family']}"
+                    index=None if len(patients) > 1 else 0,
+                    options=patients,
+                    format_func=lambda patient: labels[patient['id']]
                 )
 
                 # Reset state if patient selection changes
@@ -696,9 +645,25 @@ class App:
                 
             with col2:
                 if patient:
-                    time_range, context_types, consultation_type = self.create_context_selectors()
+                    time_range, context_types, consultation_type, language = self.create_context_selectors()
 
         if patient:
+            # Fetch the selected history once, for both the report context and the history tab
+            record_key = (self.fhir_endpoint, self.access_token, patient["id"], time_range, tuple(context_types))
+            try:
+                record = load_patient_record(*record_key)
+            except httpx.HTTPError:
+                logger.warning("Failed to load patient history", exc_info=True)
+                st.warning("Could not load the patient history from the FHIR server, reports will be written without it")
+                record = PatientRecord(timeframe_months=TIMEFRAME_MONTHS.get(time_range))
+                record_key = None
+
+            # Read the session values used below once, and write back only what changes
+            state = st.session_state
+            audio_processed = state['audio_processed']
+            transcription = state['transcription']
+            editable_report = state['editable_report']
+
             # Audio recording section
             st.subheader("Voice Input")
             
@@ -708,69 +673,78 @@ class App:
             with col1:
                 st.markdown("**Record Consultation**")
                 audio_value = st.audio_input("Record your consultation notes")
-                if audio_value is not None and not st.session_state['audio_processed']:
-                    st.session_state['audio_value'] = audio_value
-                    st.session_state['audio_source'] = 'recorded'
+                if audio_value is not None and not audio_processed:
+                    state['audio_value'] = audio_value
+                    state['audio_source'] = 'recorded'
             
             with col2:
                 st.markdown("**Upload Audio File**")
                 uploaded_file = st.file_uploader("Upload consultation audio", type=['mp3', 'wav', 'm4a'])
-                if uploaded_file is not None and not st.session_state['audio_processed']:
-                    st.session_state['audio_value'] = uploaded_file
-                    st.session_state['audio_source'] = 'uploaded'
+                if uploaded_file is not None and not audio_processed:
+                    state['audio_value'] = uploaded_file
+                    state['audio_source'] = 'uploaded'
 
-            # Process button
-            col1, col2 = st.columns(2)
+            # Process, regenerate and reset buttons
+            col1, col2, col3 = st.columns(3)
             with col1:
-                process_disabled = 'audio_value' not in st.session_state
-                if st.button("Process Consultation", type="primary", disabled=process_disabled):
-                    with st.spinner("Processing..."):
-                        # Process audio if available
-                        if 'audio_value' in st.session_state and not st.session_state['audio_processed']:
-                            transcription = self.process_audio(st.session_state['audio_value'])
-                            st.session_state['transcription'] = transcription
-                            st.session_state['audio_processed'] = True
-                        
-                        # Get patient context
-                        patient_context = self.get_patient_context(patient["id"], time_range, context_types)
-                        st.session_state['patient_context'] = patient_context
-                        
-                        # Generate report if transcription exists
-                        if st.session_state['transcription']:
-                            report = self.generate_report(
-                                patient, 
-                                st.session_state['patient_context'],
-                                st.session_state['transcription'],
-                                consultation_type
-                            )
-                            st.session_state['editable_report'] = report
-                        
-                    st.success("Processing complete!")
-
+                process_disabled = 'audio_value' not in state
+                process_clicked = st.button("Process Consultation", type="primary", disabled=process_disabled)
             with col2:
+                # Asks for a fresh completion for the same consultation, bypassing the report memo
+                regenerate_clicked = st.button("Regenerate Report", disabled=not transcription)
+            with col3:
                 if st.button("Reset"):
                     self.reset_session_state()
                     st.rerun()
 
+            if process_clicked or regenerate_clicked:
+                with st.spinner("Processing..."):
+                    # Process audio if available
+                    if process_clicked and 'audio_value' in state and not audio_processed:
+                        transcription = self.process_audio(state['audio_value'], language)
+                        state['transcription'] = transcription
+                        # A failed or empty transcription can be retried
+                        state['audio_processed'] = audio_processed = bool(transcription)
+                    
+                    # The record was already fetched for this rerun above, so this only formats it
+                    if record_key is not None:
+                        patient_context = load_patient_context(*record_key)
+                    else:
+                        patient_context = format_patient_context(record)
+                    state['patient_context'] = patient_context
+                
+                # Generate report if transcription exists, streamed into the page as it is written
+                if transcription:
+                    editable_report = st.write_stream(self.generate_report(
+                        patient, 
+                        patient_context,
+                        transcription,
+                        consultation_type,
+                        regenerate=regenerate_clicked
+                    ))
+                    state['editable_report'] = editable_report
+                    st.success("Processing complete!")
+
             # Tabs for transcription and report
             tab1, tab2, tab3 = st.tabs(["Transcription", "Report", "Patient History"])
             
             with tab1:
-                if st.session_state['transcription']:
-                    st.text_area("", st.session_state['transcription'], height=400)
+                if transcription:
+                    st.text_area("", transcription, height=400)
                 else:
                     st.info("No transcription available yet. Start recording to see the transcription here.")
 
 
             with tab2:
-                if st.session_state['editable_report'] != "No consultation recorded yet":
+                if editable_report != "No consultation recorded yet":
+                    # Edits are committed when the editor loses focus, so a button click always
+                    # sees them, and they persist through the widget key
                     edited_report = st.text_area(
                         "",
-                        value=st.session_state['editable_report'],
+                        value=editable_report,
                         height=400,
                         key="report_editor"
                     )
-                    st.session_state['editable_report'] = edited_report
 
                     # Export options
                     col1, col2 = st.columns(2)
@@ -782,43 +756,32 @@ class App:
                             filename = f"consultation_report_{current_date}.txt"
                 
                     with col2:
-                        from reportlab.lib.pagesizes import letter
-                        from reportlab.platypus import SimpleDocTemplate, Paragraph
-                        from reportlab.lib.styles import getSampleStyleSheet
-                        import io
-                        
-                        # Create in-memory PDF
-                        buffer = io.BytesIO()
-                        doc = SimpleDocTemplate(buffer, pagesize=letter)
-                        styles = getSampleStyleSheet()
-                        
-                        # Convert report content to PDF
-                        content = []
-                        for line in edited_report.split('\n'):
-                            if line.strip():  # Skip empty lines
-                                content.append(Paragraph(line, styles['Normal']))
-                        
-                        doc.build(content)
-                        
-                        # Prepare download button
-                        current_date = datetime.now().strftime("%Y%m%d")
-                        pdf_filename = f"consultation_report_{current_date}.pdf"
-                        
-                        st.download_button(
-                            label="Save as PDF",
-                            data=buffer.getvalue(),
-                            file_name=pdf_filename,
-                            mime="application/pdf"
-                        )
+                        # Only lay out the PDF once it is asked for, and ask again after an edit
+                        # so the download never holds an older version of the report
+                        if state['pdf_report'] != edited_report:
+                            if st.button("Prepare PDF"):
+                                state['pdf_report'] = edited_report
+                                st.rerun()
+                        else:
+                            # Prepare download button
+                            current_date = datetime.now().strftime("%Y%m%d")
+                            pdf_filename = f"consultation_report_{current_date}.pdf"
+                            
+                            st.download_button(
+                                label="Save as PDF",
+                                data=render_report_pdf(edited_report),
+                                file_name=pdf_filename,
+                                mime="application/pdf"
+                            )
                 else:
                     st.info("No consultation recorded yet. Record and process consultation to generate a report.")
             with tab3:
                 if patient:
-                    self.display_patient_history(patient["id"], time_range, context_types)
+                    self.display_patient_history(record, time_range)
                 else:
                     st.info("Select a patient to view their history.")
 
 if 'token' not in st.session_state:
     st.switch_page('main.py')
 else:
-    App().render_page()
\ No newline at end of file
+    App(stx.CookieManager(key='cookie_manager')).render_page()
\ No newline at end of file
@@ -0,0 +1,397 @@
+"""
+Parsing and formatting of a patient's FHIR history.
+
+Kept out of the page script so PatientRecord is an importable class, which
+st.cache_data can pickle and restore the same way on every rerun.
+"""
+import base64
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+import streamlit as st
+
+
+def first_coding(concept, field, default=''):
+    """Return a field of the first coding in a FHIR CodeableConcept."""
+    codings = concept.get('coding') if concept else None
+    return codings[0].get(field, default) if codings else default
+
+
+def coding_displays(concepts):
+    """Return the display of every coding in a list of FHIR CodeableConcepts."""
+    return [coding.get('display', '') for concept in concepts for coding in concept.get('coding', [])]
+
+
+def parse_fhir_date(value):
+    """Parse a FHIR date or dateTime into a naive UTC datetime, or None if it is missing or invalid."""
+    if not value:
+        return None
+    # FHIR allows partial dates such as "2020" and "2020-05"
+    if len(value) == 4:
+        value += "-01-01"
+    elif len(value) == 7:
+        value += "-01"
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+@st.cache_data(ttl=60, show_spinner=False)
+def get_cutoff_date(timeframe_months):
+    """Oldest date inside the timeframe, as a naive UTC datetime."""
+    return datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=30 * timeframe_months)
+
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def decode_presented_form(data_b64):
+    """Decode a report's Base64 body once instead of on every rerun."""
+    return base64.b64decode(data_b64).decode('utf-8')
+
+
+@dataclass
+class PatientRecord:
+    """Parsed patient history for the selected context types."""
+    timeframe_months: Optional[int] = None
+    allergies: Optional[list] = None
+    active_meds: Optional[list] = None
+    historical_meds: Optional[list] = None
+    active_conditions: Optional[list] = None
+    historical_conditions: Optional[list] = None
+    recent_reports: Optional[list] = None
+    older_reports: Optional[list] = None
+
+
+def fetch_allergies(results):
+    if 'entry' not in results or len(results['entry']) == 0:
+        return None
+    
+    allergy_list = []
+    for entry in results['entry']:
+        resource = entry['resource']
+        get = resource.get
+        code = resource['code']
+        
+        # Get allergy name from the code display or text
+        allergy_name = code.get('text', '')
+        if not allergy_name and 'coding' in code:
+            allergy_name = first_coding(code, 'display', 'Unknown')
+            
+        # Extract basic information
+        allergy_info = {
+            'name': allergy_name,
+            'type': get('type', ''),
+            'category': get('category', []),
+            'criticality': get('criticality', ''),
+            'clinical_status': first_coding(get('clinicalStatus'), 'code'),
+            'recorded_date': get('recorded_date', '')
+        }
+        
+        allergy_list.append(allergy_info)
+    return allergy_list
+
+
+def format_allergies(allergy_list):
+    parts = ["The patient has the following allergies:\n"]
+    for i, allergy in enumerate(allergy_list, 1):
+        parts.append(f"""
+            Name: {allergy['name']}
+            Category: {', '.join(allergy['category'])}
+            Criticality: {allergy['criticality']}
+            Clinical Status: {allergy['clinical_status']}\n
+            """)
+    return "".join(parts)
+
+
+def fetch_conditions(results, timeframe_months=3):
+    if 'entry' not in results or len(results['entry']) == 0:
+        return None, None
+    
+    # Calculate the cutoff date based on timeframe
+    if timeframe_months:
+        cutoff_date = get_cutoff_date(timeframe_months)
+    
+    active_conditions = []
+    historical_conditions = []
+    
+    for entry in results['entry']:
+        resource = entry['resource']
+        get = resource.get
+        
+        # Extract condition information
+        condition_info = {
+            'name': first_coding(resource['code'], 'display'),
+            'clinical_status': first_coding(get('clinicalStatus'), 'code'),
+            'verification_status': first_coding(get('verificationStatus'), 'code'),
+            'category': coding_displays(get('category', [])),
+            'onset_date': get('onsetDateTime', ''),
+            'abatement_date': get('abatementDateTime', ''),
+            'recorded_date': get('recordedDate', '')
+        }
+        
+        # Determine if condition is active or historical
+        if condition_info['clinical_status'] == 'active':
+            active_conditions.append(condition_info)
+        else:
+            # Only include historical conditions within the specified timeframe
+            if timeframe_months:
+                recorded_date = parse_fhir_date(condition_info['recorded_date'])
+                if recorded_date and recorded_date >= cutoff_date:
+                    historical_conditions.append(condition_info)
+            else:
+                historical_conditions.append(condition_info)
+    return active_conditions, historical_conditions
+
+
+def format_conditions(active_conditions, historical_conditions, timeframe_months=3):
+    parts = ["Patient's Current Medical Conditions:\n"]
+    if active_conditions:
+        for condition in active_conditions:
+            parts.append(f"""
+                Condition: {condition['name']}
+                Status: {condition['clinical_status']}
+                Category: {', '.join(condition['category']) if condition['category'] else 'Not specified'}
+                Onset Date: {condition['onset_date']}\n""")
+    else:
+        parts.append("No active medical conditions.\n")
+    
+    if timeframe_months:
+        parts.append(f"\nResolved Conditions (Past {timeframe_months} months):\n")
+    else:
+        parts.append("\nHistorical Conditions:\n")
+    
+    if historical_conditions:
+        for condition in historical_conditions:
+            parts.append(f"""
+                Condition: {condition['name']}
+                Status: {condition['clinical_status']}
+                Category: {', '.join(condition['category']) if condition['category'] else 'Not specified'}
+                Onset Date: {condition['onset_date']}
+                Resolved Date: {condition['abatement_date']}\n""")
+    else:
+        parts.append("No historical conditions in the specified timeframe.\n")
+
+    return "".join(parts)
+
+
+def fetch_medications(results, timeframe_months=3):
+    if 'entry' not in results or len(results['entry']) == 0:
+        return None, None
+    
+    # Calculate the cutoff date based on timeframe
+    if timeframe_months:
+        cutoff_date = get_cutoff_date(timeframe_months)
+    
+    active_medications = []
+    historical_medications = []
+    
+    for entry in results['entry']:
+        resource = entry['resource']
+        get = resource.get
+        
+        # Extract medication information
+        med_info = {
+            'id': get('id', ''),
+            'status': get('status', ''),
+            'category': first_coding((get('category') or [None])[0], 'display'),
+            'medication': '',  # Will be filled below
+            'authored_date': get('authoredOn', ''),
+            'prescriber': get('requester', {}).get('display', ''),
+            'reason': [ref.get('display', '') for ref in get('reasonReference', [])]
+        }
+        
+        # Get medication name either from medicationCodeableConcept or medicationReference
+        if 'medicationCodeableConcept' in resource:
+            concept = resource['medicationCodeableConcept']
+            if 'coding' in concept:
+                med_info['medication'] = first_coding(concept, 'display')
+            else:
+                med_info['medication'] = concept.get('text', '')
+        elif 'medicationReference' in resource:
+            med_info['medication'] = resource['medicationReference'].get('display', '')
+            
+        # Categorize as active or historical
+        if med_info['status'] in ['active', 'intended']:
+            active_medications.append(med_info)
+        elif med_info['status'] in ['stopped', 'completed']:
+            if timeframe_months:
+                authored_date = parse_fhir_date(med_info['authored_date'])
+                if authored_date and authored_date >= cutoff_date:
+                    historical_medications.append(med_info)
+            else:
+                historical_medications.append(med_info)
+    return active_medications, historical_medications
+
+
+def format_medications(active_medications, historical_medications, timeframe_months=3):
+    parts = ["Patient's Current Medications:\n"]
+    if active_medications:
+        for med in active_medications:
+            parts.append(f"""
+                Medication: {med['medication']}
+                Status: {med['status']}
+                Category: {med['category']}
+                Prescribed by: {med['prescriber']}
+                Prescribed Date: {med['authored_date']}""")
+            if med['reason']:
+                parts.append(f"\n            Reason: {', '.join(med['reason'])}\n")
+            else:
+                parts.append("\n")
+    else:
+        parts.append("No active medications.\n")
+    
+    if timeframe_months:
+        parts.append(f"\nDiscontinued Medications (Past {timeframe_months} months):\n")
+    else:
+        parts.append("\nHistorical Medications:\n")
+    
+    if historical_medications:
+        for med in historical_medications:
+            parts.append(f"""
+                Medication: {med['medication']}
+                Status: {med['status']}
+                Category: {med['category']}
+                Prescribed by: {med['prescriber']}
+                Prescribed Date: {med['authored_date']}""")
+            if med['reason']:
+                parts.append(f"\n            Reason: {', '.join(med['reason'])}\n")
+            else:
+                parts.append("\n")
+    else:
+        parts.append("No historical medications in the specified timeframe.\n")
+    return "".join(parts)
+
+
+def fetch_reports(results, timeframe_months=3):
+    if 'entry' not in results or len(results['entry']) == 0:
+        return None, None
+    
+    # Calculate the cutoff date based on timeframe
+    if timeframe_months:
+        cutoff_date = get_cutoff_date(timeframe_months)
+    
+    recent_reports = []
+    older_reports = []
+    
+    for entry in results['entry']:
+        resource = entry['resource']
+        if 'presentedForm' in resource and resource['presentedForm']:
+            # Get the Base64 encoded data
+            encoded_data = resource['presentedForm'][0]['data']
+            
+            # Decode the Base64 data
+            decoded_data = decode_presented_form(encoded_data)
+            
+            # Get basic report metadata
+            get = resource.get
+            report_info = {
+                'id': get('id', ''),
+                'status': get('status', ''),
+                'effective_date': get('effectiveDateTime', ''),
+                'performer': (get('performer') or [{}])[0].get('display', ''),
+                'content': decoded_data,
+                'category': coding_displays(get('category', [])),
+                'code': coding_displays([get('code', {})])
+            }
+            
+            # Categorize based on timeframe
+            effective_date = parse_fhir_date(report_info['effective_date'])
+            if timeframe_months and effective_date:
+                if effective_date >= cutoff_date:
+                    recent_reports.append(report_info)
+                else:
+                    older_reports.append(report_info)
+            else:
+                recent_reports.append(report_info)
+    return recent_reports, older_reports
+
+
+def format_reports(recent_reports, older_reports, timeframe_months=3):
+    parts = []
+    if timeframe_months:
+        parts.append(f"Diagnostic Reports (Past {timeframe_months} months):\n")
+    else:
+        parts.append("All Diagnostic Reports:\n")
+    parts.append("-" * 50 + "\n")
+    
+    if recent_reports:
+        for report in recent_reports:
+            parts.append(f"""
+    Report Type: {', '.join(report['code'])}
+    Status: {report['status']}
+    Category: {', '.join(report['category'])}
+    Date: {report['effective_date']}
+    Provider: {report['performer']}
+
+    Content:
+    {report['content']}
+    {'=' * 50}\n""")
+    else:
+        parts.append("No recent diagnostic reports found.\n")
+    
+    if timeframe_months and older_reports:
+        parts.append(f"\nOlder Reports (Before {timeframe_months} months):\n")
+        parts.append("-" * 50 + "\n")
+        for report in older_reports:
+            parts.append(f"""
+    Report Type: {', '.join(report['code'])}
+    Status: {report['status']}
+    Category: {', '.join(report['category'])}
+    Date: {report['effective_date']}
+    Provider: {report['performer']}
+
+    Content:
+    {report['content']}
+    {'=' * 50}\n""")
+    
+    return "".join(parts)
+
+
+def parse_patient_record(results, timeframe_months) -> PatientRecord:
+    """
+    Parse the search bundles of the selected context types into a PatientRecord.
+
+    Args:
+        results: Searchset bundle for each selected context type, keyed by context type
+        timeframe_months: Months of history to keep, or None for all of it
+    """
+    record = PatientRecord(timeframe_months=timeframe_months)
+    if "Allergies" in results:
+        record.allergies = fetch_allergies(results["Allergies"])
+    if "Medications" in results:
+        record.active_meds, record.historical_meds = fetch_medications(
+            results["Medications"], timeframe_months
+        )
+    if "Previous Conditions" in results:
+        record.active_conditions, record.historical_conditions = fetch_conditions(
+            results["Previous Conditions"], timeframe_months
+        )
+    if "Previous Reports" in results:
+        record.recent_reports, record.older_reports = fetch_reports(
+            results["Previous Reports"], timeframe_months
+        )
+    return record
+
+
+def format_patient_context(record: PatientRecord) -> str:
+    """Format a patient's history for the report prompt; unselected or empty context types are None."""
+    parts = []
+    if record.allergies is not None:
+        parts.append(format_allergies(record.allergies))
+    if record.active_meds is not None:
+        parts.append(format_medications(
+            record.active_meds, record.historical_meds, record.timeframe_months
+        ))
+    if record.active_conditions is not None:
+        parts.append(format_conditions(
+            record.active_conditions, record.historical_conditions, record.timeframe_months
+        ))
+    if record.recent_reports is not None:
+        parts.append(format_reports(
+            record.recent_reports, record.older_reports, record.timeframe_months
+        ))
+    return "".join(parts)
@@ -1,60 +1,303 @@
 import os
-import io
-import math
+import shutil
 import subprocess
+import threading
+import uuid
 import tempfile
-from typing import  List
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import lru_cache
+from queue import Empty, SimpleQueue
+from typing import BinaryIO, Iterator, List, Optional, Tuple, Union
 
-from pydub import AudioSegment
+import numpy as np
 
+# Seconds a presigned chunk URL stays valid, long enough for Groq to fetch it
+PRESIGNED_URL_EXPIRY = 600
+# Chunks are uploaded as speech-tuned Opus, roughly 10x smaller than 16 kHz PCM WAV
+CHUNK_BITRATE_KBPS = 24
+# Largest chunk to send to Groq, just under its 25 MB request limit
+MAX_CHUNK_BYTES = 24 * 1024 * 1024
+# Least speech per chunk when the duration is chosen from the recording, so short
+# recordings are not cut into many small requests
+MIN_CHUNK_SECONDS = 600
+# Sample rate the VAD runs at and chunks are encoded with
+SAMPLE_RATE = 16000
+# Pauses at least this long are treated as silence the audio can be cut on
+MIN_SILENCE_MS = 300
+# Audio kept either side of each speech segment, so trimmed pauses still sound like pauses
+SPEECH_PAD_MS = 100
+# Containers ffmpeg cannot read from a pipe, as their index may sit at the end of the file
+SEEKABLE_SUFFIXES = (".m4a", ".mp4")
+# Chunks encoded at the same time, each export runs its own ffmpeg process
+EXPORT_WORKERS = 8
 
-def split_audio(audio_path: str, chunk_duration: int = 600) -> List[str]:
+# Idle VAD models. A model keeps internal state while it scans, so each scan takes one
+# for itself, and concurrent sessions load another instead of waiting their turn
+_vad_models = SimpleQueue()
+
+
+@contextmanager
+def _vad_model():
+    from silero_vad import load_silero_vad
+
+    try:
+        model = _vad_models.get_nowait()
+    except Empty:
+        model = load_silero_vad()
+    try:
+        yield model
+    finally:
+        _vad_models.put(model)
+
+
+def speech_segments(samples: np.ndarray, max_samples: int) -> List[Tuple[int, int]]:
     """
-    Split audio file into chunks of specified duration.
+    Find speech in audio.
     
     Args:
-        audio_path: Path to the audio file
-        chunk_duration: Duration of each chunk in seconds (default: 600s = 10 minutes)
+        samples: Mono float32 samples at SAMPLE_RATE
+        max_samples: Longest speech segment in samples, longer speech is split
     
     Returns:
-        List of paths to audio chunks
+        (start, end) sample offsets of each speech segment
     """
-    # Load audio file
-    audio = AudioSegment.from_file(audio_path)
+    from silero_vad import get_speech_timestamps
+
+    with _vad_model() as model:
+        timestamps = get_speech_timestamps(
+            samples,
+            model,
+            sampling_rate=SAMPLE_RATE,
+            threshold=0.5,
+            min_silence_duration_ms=MIN_SILENCE_MS,
+            speech_pad_ms=SPEECH_PAD_MS,
+            max_speech_duration_s=max_samples / SAMPLE_RATE
+        )
+    return [(timestamp['start'], timestamp['end']) for timestamp in timestamps]
+
+
+def speech_regions(segments: List[Tuple[int, int]], max_samples: int) -> List[List[Tuple[int, int]]]:
+    """
+    Group neighbouring speech segments into regions of at most max_samples of speech.
     
-    # Calculate number of chunks needed
-    total_duration = len(audio) / 1000  # Convert to seconds
-    num_chunks = math.ceil(total_duration / chunk_duration)
+    Only the speech counts towards the limit, the silence between segments is dropped.
+    Segments must be no longer than max_samples.
+    """
+    regions = []
+    region_samples = 0
+    for start, end in segments:
+        if regions and region_samples + end - start <= max_samples:
+            regions[-1].append((start, end))
+            region_samples += end - start
+        else:
+            regions.append([(start, end)])
+            region_samples = end - start
+    return regions
+
+
+def max_chunk_duration(max_bytes: int = MAX_CHUNK_BYTES) -> int:
+    """Seconds of speech that fit in max_bytes once encoded at CHUNK_BITRATE_KBPS."""
+    bytes_per_second = CHUNK_BITRATE_KBPS * 1000 // 8
+    # Opus is variable bitrate and Ogg adds page headers, so leave a quarter of the budget spare
+    return max_bytes * 3 // (4 * bytes_per_second)
+
+
+@contextmanager
+def split_audio(
+    audio: Union[str, BinaryIO],
+    chunk_duration: Optional[int] = None,
+    workers: int = 1
+) -> Iterator[Iterator[Tuple[int, str]]]:
+    """
+    Split audio into chunks of at most the specified duration of speech, cut on silence.
+    
+    The audio is decoded and resampled to 16kHz mono in the same ffmpeg pass. Silence
+    is dropped between and within chunks, leaving SPEECH_PAD_MS either side of each
+    speech segment, so it is never uploaded or transcribed.
+    Chunks are written to a private temporary directory that is removed, with
+    anything left in it, when the context exits.
+    
+    Args:
+        audio: Path to the audio file, or an open binary file such as an upload
+        chunk_duration: Maximum duration of speech in each chunk in seconds, capped by
+            what fits in MAX_CHUNK_BYTES (default: the speech in the recording shared
+            between workers, but at least MIN_CHUNK_SECONDS)
+        workers: Chunks that will be transcribed at the same time, used to choose the
+            default chunk duration
+    
+    Yields:
+        Iterator over the index and path of each Opus-encoded audio chunk as soon as
+        it is written, which is not necessarily in chunk order
+    """
+    with tempfile.TemporaryDirectory(prefix="sagescript_", ignore_cleanup_errors=True) as temp_dir:
+        chunks = _export_chunks(audio, chunk_duration, workers, temp_dir)
+        try:
+            yield chunks
+        finally:
+            # Stops any exports still running before their directory is removed
+            chunks.close()
+
+
+def _export_chunks(
+    audio: Union[str, BinaryIO],
+    chunk_duration: Optional[int],
+    workers: int,
+    temp_dir: str
+) -> Iterator[Tuple[int, str]]:
+    # Decode to mono PCM at the VAD sample rate
+    pcm = _decode_audio(audio, temp_dir)
+    samples = pcm.astype(np.float32)
+    samples /= 1 << 15
     
-    chunk_paths = []
-    temp_dir = tempfile.mkdtemp()
+    max_samples = max_chunk_duration() * SAMPLE_RATE
+    segments = speech_segments(samples, max_samples)
+    del samples
     
-    # Split audio into chunks
-    for i in range(num_chunks):
-        start_time = i * chunk_duration * 1000  # Convert to milliseconds
-        end_time = min((i + 1) * chunk_duration * 1000, len(audio))
-        
-        chunk = audio[start_time:end_time]
-        chunk_path = os.path.join(temp_dir, f"chunk_{i}.wav")
-        chunk.export(chunk_path, format="wav")
-        chunk_paths.append(chunk_path)
+    if chunk_duration:
+        max_samples = min(chunk_duration * SAMPLE_RATE, max_samples)
+    else:
+        # Share the speech between the workers, without cutting it into needlessly short chunks
+        speech_samples = sum(end - start for start, end in segments)
+        max_samples = min(max(-(-speech_samples // workers), MIN_CHUNK_SECONDS * SAMPLE_RATE), max_samples)
+    regions = speech_regions(_split_segments(segments, max_samples), max_samples)
     
-    return chunk_paths
+    with ThreadPoolExecutor(max_workers=max(1, min(len(regions), EXPORT_WORKERS))) as executor:
+        try:
+            # Export the speech regions concurrently
+            futures = {
+                executor.submit(_export_chunk, pcm, segments, os.path.join(temp_dir, f"chunk_{i}.ogg")): i
+                for i, segments in enumerate(regions)
+            }
+            
+            # Yield each chunk as soon as its export finishes, so a slow chunk does not hold back the rest
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        except BaseException:
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+
+
+def _split_segments(segments: List[Tuple[int, int]], max_samples: int) -> List[Tuple[int, int]]:
+    """Cut speech segments longer than max_samples into pieces of at most max_samples."""
+    pieces = []
+    for start, end in segments:
+        for piece_start in range(start, end, max_samples):
+            pieces.append((piece_start, min(piece_start + max_samples, end)))
+    return pieces
+
+
+def _decode_audio(audio: Union[str, BinaryIO], temp_dir: str) -> np.ndarray:
+    """Decode an audio file or file-like to mono 16-bit PCM at SAMPLE_RATE."""
+    if not isinstance(audio, str) and getattr(audio, "name", "").lower().endswith(SEEKABLE_SUFFIXES):
+        spooled_path = os.path.join(temp_dir, "input" + os.path.splitext(audio.name)[1])
+        with open(spooled_path, "wb") as file:
+            audio.seek(0)
+            shutil.copyfileobj(audio, file)
+        try:
+            return _decode_audio(spooled_path, temp_dir)
+        finally:
+            _remove_quietly(spooled_path)
+
+    is_path = isinstance(audio, str)
+    process = subprocess.Popen(
+        [
+            "ffmpeg", "-loglevel", "error",
+            "-i", audio if is_path else "pipe:0",
+            # soxr resamples faster and cleaner than ffmpeg's default swr resampler
+            "-af", "aresample=resampler=soxr",
+            "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE),
+            "pipe:1"
+        ],
+        stdin=subprocess.DEVNULL if is_path else subprocess.PIPE,
+        stdout=subprocess.PIPE
+    )
+    if not is_path:
+        # Stream the upload into ffmpeg in small blocks while its output is read below
+        audio.seek(0)
+        writer = threading.Thread(target=_feed_stdin, args=(audio, process.stdin), daemon=True)
+        writer.start()
+    with process.stdout:
+        pcm = process.stdout.read()
+    if process.wait():
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+    return np.frombuffer(pcm, dtype=np.int16)
+
+
+def _feed_stdin(source: BinaryIO, stdin: BinaryIO) -> None:
+    try:
+        with stdin:
+            shutil.copyfileobj(source, stdin)
+    except BrokenPipeError:
+        # ffmpeg stopped reading, its exit status says why
+        pass
+
+
+def _export_chunk(pcm: np.ndarray, segments: List[Tuple[int, int]], chunk_path: str) -> str:
+    """Encode speech segments of mono 16-bit PCM at SAMPLE_RATE back to back as an Opus chunk."""
+    process = subprocess.Popen(
+        [
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "-i", "-",
+            "-c:a", "libopus", "-b:a", f"{CHUNK_BITRATE_KBPS}k",
+            chunk_path
+        ],
+        stdin=subprocess.PIPE
+    )
+    try:
+        with process.stdin:
+            for start, end in segments:
+                # A byte view of each segment, so the decoded buffer is never copied or joined
+                process.stdin.write(memoryview(pcm[start:end]).cast("B"))
+    except BrokenPipeError:
+        # ffmpeg stopped reading, its exit status says why
+        pass
+    if process.wait():
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+    return chunk_path
+
 
+def _remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
 
-def preprocess_audio(input_file) -> str:
+
+def remove_in_background(path: str) -> None:
+    """Delete a temporary file on a daemon thread so the caller does not wait on the filesystem."""
+    threading.Thread(target=_remove_quietly, args=(path,), daemon=True).start()
+
+
+@lru_cache(maxsize=None)
+def _s3_client():
+    # boto3 is only needed when chunks are uploaded to a bucket
+    import boto3
+    return boto3.client("s3")
+
+
+def upload_audio_chunk(chunk_path: str, bucket: str) -> Tuple[str, str]:
     """
-    Preprocess audio file to match Groq's requirements (16kHz mono).
+    Upload an audio chunk to S3 so it can be transcribed by URL.
+    
+    Args:
+        chunk_path: Path to the audio chunk
+        bucket: Name of the S3 bucket to upload to
+    
+    Returns:
+        Object key and presigned GET URL of the uploaded chunk
     """
-    temp_dir = tempfile.gettempdir()
-    output_file = os.path.join(temp_dir, "processed_audio.wav")
+    key = f"sagescript/{uuid.uuid4().hex}/{os.path.basename(chunk_path)}"
+    s3 = _s3_client()
+    s3.upload_file(chunk_path, bucket, key)
+    url = s3.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": bucket, "Key": key},
+        ExpiresIn=PRESIGNED_URL_EXPIRY
+    )
+    return key, url
 
-    # Convert to AudioSegment
-    audio_bytes = input_file.read()
-    audio_segment = AudioSegment.from_wav(io.BytesIO(audio_bytes))
-    
-    # Resample to 16kHz and save to file
-    audio_segment = audio_segment.set_frame_rate(16000)
-    audio_segment.export(output_file, format="wav")
 
-    return output_file
+def delete_audio_chunk(bucket: str, key: str) -> None:
+    """Delete an uploaded audio chunk from S3."""
+    _s3_client().delete_object(Bucket=bucket, Key=key)